@@ -1,16 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from typing import Optional
-from datetime import datetime, timedelta
-from ..utils.dynamodb import get_dynamodb_resource
-from .jwt import create_access_token, get_current_user
-import uuid
-import boto3
-import bcrypt
+from datetime import timedelta
+from ..utils.dynamodb import get_users_table, serialize_item
+from ..utils.responses import ORJSONResponse
+from ..utils.ids import new_id, now_iso
+from .jwt import oauth2_scheme, create_access_token, forget_token, CurrentUser
+from .passwords import hash_password, verify_password, password_needs_rehash, run_in_password_pool
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
 router = APIRouter()
 
+_EMAIL_KEY = Key("email")
+
 # Models
 class UserBase(BaseModel):
     email: str
@@ -33,22 +37,12 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
-# DynamoDB resource
-dynamodb = get_dynamodb_resource()
-users_table = dynamodb.Table("food_stall_finder_users")
-
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register_user(user: UserCreate):
-    # Check if user already exists
-    response = users_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr("email").eq(user.email)
-    )
-    if response["Items"]:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="User with this email already exists"
-        )
-    
+async def register_user(
+    user: UserCreate,
+    request: Request,
+    users_table=Depends(get_users_table)
+):
     # Validate user type
     if user.user_type not in ["owner", "customer"]:
         raise HTTPException(
@@ -57,11 +51,13 @@ async def register_user(user: UserCreate):
         )
     
     # Hash password
-    hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed_password = await run_in_password_pool(
+        request.app.state.password_pool, hash_password, user.password
+    )
     
     # Create user
-    user_id = str(uuid.uuid4())
-    timestamp = datetime.utcnow().isoformat()
+    user_id = new_id()
+    timestamp = now_iso()
     
     new_user = {
         "user_id": user_id,
@@ -73,7 +69,32 @@ async def register_user(user: UserCreate):
         "updated_at": timestamp
     }
     
-    users_table.put_item(Item=new_user)
+    # Write the user together with an email marker item in one transaction;
+    # the marker's condition rejects an email that is already registered
+    email_marker = {
+        "user_id": f"EMAIL#{user.email}",
+        "email_owner_id": user_id
+    }
+    
+    try:
+        await users_table.meta.client.transact_write_items(
+            TransactItems=[
+                {"Put": {"TableName": users_table.name, "Item": serialize_item(new_user)}},
+                {"Put": {
+                    "TableName": users_table.name,
+                    "Item": serialize_item(email_marker),
+                    "ConditionExpression": "attribute_not_exists(user_id)"
+                }}
+            ]
+        )
+    except ClientError as e:
+        reasons = e.response.get("CancellationReasons", [])
+        if not any(reason.get("Code") == "ConditionalCheckFailed" for reason in reasons):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="User with this email already exists"
+        )
     
     return {
         "user_id": user_id,
@@ -84,39 +105,71 @@ async def register_user(user: UserCreate):
     }
 
 @router.post("/login", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login_for_access_token(
+    request: Request,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    users_table=Depends(get_users_table)
+):
     # Get user
-    response = users_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr("email").eq(form_data.username)
+    response = await users_table.query(
+        IndexName="email-index",
+        KeyConditionExpression=_EMAIL_KEY.eq(form_data.username),
+        Limit=1
     )
     
-    if not response["Items"]:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect email or password",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+    user = response["Items"][0] if response["Count"] == 1 else None
     
-    user = response["Items"][0]
+    # Verify password, against a dummy hash for unknown emails so they take
+    # as long as a wrong password and don't reveal which accounts exist
+    password_pool = request.app.state.password_pool
+    password_valid = await run_in_password_pool(
+        password_pool, verify_password, form_data.password, user["password"] if user else None
+    )
     
-    # Verify password
-    if not bcrypt.checkpw(form_data.password.encode('utf-8'), user["password"].encode('utf-8')):
+    if user is None or not password_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Upgrade legacy bcrypt hashes now that we have the plain password
+    if password_needs_rehash(user["password"]):
+        await users_table.update_item(
+            Key={"user_id": user["user_id"]},
+            UpdateExpression="SET password = :password",
+            ExpressionAttributeValues={
+                ":password": await run_in_password_pool(password_pool, hash_password, form_data.password)
+            }
+        )
+    
     # Create access token
     access_token_expires = timedelta(minutes=60 * 24 * 7)  # 7 days
     access_token = create_access_token(
-        data={"sub": user["user_id"]}, expires_delta=access_token_expires
+        data={"sub": user["user_id"], "ver": int(user.get("token_version", 0))},
+        expires_delta=access_token_expires
     )
     
     return {"access_token": access_token, "token_type": "bearer"}
 
-@router.get("/me", response_model=UserResponse)
-async def read_users_me(current_user: dict = Depends(get_current_user)):
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
+async def logout(
+    current_user: CurrentUser,
+    token: str = Depends(oauth2_scheme),
+    users_table=Depends(get_users_table)
+) -> Response:
+    # Revoke every token issued so far by moving the user to a new version
+    await users_table.update_item(
+        Key={"user_id": current_user["user_id"]},
+        UpdateExpression="ADD token_version :one",
+        ExpressionAttributeValues={":one": 1}
+    )
+    forget_token(token)
+    
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+@router.get("/me", response_model=UserResponse, response_class=ORJSONResponse)
+async def read_users_me(current_user: CurrentUser):
     return {
         "user_id": current_user["user_id"],
         "email": current_user["email"],
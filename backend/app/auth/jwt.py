@@ -1,14 +1,26 @@
 from datetime import datetime, timedelta
-from typing import Optional
-from jose import JWTError, jwt
+from typing import Annotated, Optional
+from cachetools import TTLCache
+import hashlib
+import time
+import jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from ..config import settings
-from ..utils.dynamodb import get_dynamodb_resource
+from ..utils.dynamodb import get_users_table
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
-dynamodb = get_dynamodb_resource()
-users_table = dynamodb.Table("food_stall_finder_users")
+
+# Encoded once instead of on every sign/verify
+_secret_key = settings.SECRET_KEY.encode("utf-8")
+
+# Authenticated users keyed by a digest of their token, so repeat requests
+# skip the JWT decode and the DynamoDB lookup for a while; logging out drops
+# the entry here and other workers stop honouring the token within the TTL
+_user_cache = TTLCache(maxsize=10000, ttl=60)
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -19,40 +31,69 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + timedelta(minutes=15)
         
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, _secret_key, algorithm=settings.ALGORITHM)
     
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    users_table=Depends(get_users_table)
+):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    # Serve from cache while the token is still unexpired
+    cache_key = _token_cache_key(token)
+    cached = _user_cache.get(cache_key)
+    
+    if cached is not None:
+        expires_at, user = cached
+        if expires_at > time.time():
+            return user
+    
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = jwt.decode(token, _secret_key, algorithms=[settings.ALGORITHM])
         user_id: str = payload.get("sub")
         
         if user_id is None:
             raise credentials_exception
             
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise credentials_exception
         
     # Get user from DynamoDB
-    response = users_table.get_item(Key={"user_id": user_id})
+    response = await users_table.get_item(Key={"user_id": user_id})
     user = response.get("Item")
     
-    if user is None:
+    # Tokens issued before the user's last logout are revoked
+    if user is None or payload.get("ver", 0) != user.get("token_version", 0):
         raise credentials_exception
+    
+    _user_cache[cache_key] = (payload.get("exp", 0), user)
         
     return user
 
-async def get_current_owner(current_user: dict = Depends(get_current_user)):
+def forget_token(token: str) -> None:
+    """
+    Drop a token's cached user so it is checked against the database again
+    
+    Args:
+        token: The raw bearer token
+    """
+    _user_cache.pop(_token_cache_key(token), None)
+
+CurrentUser = Annotated[dict, Depends(get_current_user)]
+
+# Async so FastAPI calls it inline instead of dispatching to its threadpool
+async def require_owner(current_user: CurrentUser) -> dict:
     if current_user["user_type"] != "owner":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User is not an owner"
         )
-    return current_user
\ No newline at end of file
+    return current_user
+
+CurrentOwner = Annotated[dict, Depends(require_owner)]
\ No newline at end of file
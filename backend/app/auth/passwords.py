@@ -0,0 +1,108 @@
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import asyncio
+import os
+import bcrypt
+
+_hasher = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=4)
+
+# Verified against when a user doesn't exist so the miss costs a full hash
+_DUMMY_HASH = _hasher.hash("dummy-password")
+
+def _is_bcrypt_hash(hashed_password: str) -> bool:
+    return hashed_password.startswith(("$2a$", "$2b$", "$2y$"))
+
+def hash_password(password: str) -> str:
+    """
+    Hash a password with Argon2id
+
+    Args:
+        password: The plain text password
+
+    Returns:
+        The self-describing Argon2 hash string
+    """
+    return _hasher.hash(password)
+
+def verify_password(password: str, hashed_password: Optional[str]) -> bool:
+    """
+    Verify a password against a stored Argon2 or legacy bcrypt hash
+
+    Args:
+        password: The plain text password
+        hashed_password: The hash stored for the user, or None if there is no user
+
+    Returns:
+        True if the password matches, always False without a stored hash
+    """
+    if hashed_password is None:
+        try:
+            _hasher.verify(_DUMMY_HASH, password)
+        except VerificationError:
+            pass
+        return False
+
+    # Argon2 takes both strings as-is; only legacy bcrypt needs bytes
+    if _is_bcrypt_hash(hashed_password):
+        password_bytes = password.encode('utf-8')
+        hash_bytes = hashed_password.encode('ascii')
+        return bcrypt.checkpw(password_bytes, hash_bytes)
+
+    try:
+        return _hasher.verify(hashed_password, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """
+    Check whether a stored hash should be upgraded to the current parameters
+
+    Args:
+        hashed_password: The hash stored for the user
+
+    Returns:
+        True for legacy bcrypt hashes and outdated Argon2 parameters
+    """
+    return _is_bcrypt_hash(hashed_password) or _hasher.check_needs_rehash(hashed_password)
+
+def _warm_up() -> None:
+    return None
+
+def create_password_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Create the process pool that password hashing runs in
+
+    Hashing is CPU-bound and holds the GIL, so it runs in worker processes
+    to keep the event loop free for other requests.
+
+    Args:
+        max_workers: Number of worker processes, defaults to the CPU count
+
+    Returns:
+        A pre-warmed ProcessPoolExecutor
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    # Start every worker now so the first logins don't pay for process start-up
+    for _ in range(max_workers):
+        pool.submit(_warm_up)
+
+    return pool
+
+async def run_in_password_pool(pool: ProcessPoolExecutor, func, *args):
+    """
+    Run a password function in the process pool without blocking the event loop
+
+    Args:
+        pool: The pool created by create_password_pool
+        func: A module-level function from this module
+        *args: Arguments for func
+
+    Returns:
+        The result of func
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, func, *args)
@@ -1,5 +1,7 @@
 import os
-from pydantic import BaseSettings, AnyHttpUrl
+from typing import Optional
+from pydantic import AnyHttpUrl, Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
     API_V1_STR: str = "/api/v1"
@@ -24,14 +26,18 @@ class Settings(BaseSettings):
     DYNAMODB_MENU_ITEMS_TABLE: str = os.getenv("DYNAMODB_MENU_ITEMS_TABLE", "food_stall_finder_menu_items")
     DYNAMODB_REVIEWS_TABLE: str = os.getenv("DYNAMODB_REVIEWS_TABLE", "food_stall_finder_reviews")
     
+    # Redis Settings, caching is disabled when no URL is set
+    REDIS_URL: Optional[str] = os.getenv("REDIS_URL")
+    
     # Google Maps API Key
     GOOGLE_MAPS_API_KEY: str = os.getenv("GOOGLE_MAPS_API_KEY", "")
     
-    # CORS Settings
-    BACKEND_CORS_ORIGINS: list[AnyHttpUrl] = []
+    # Server Settings, uvicorn's CLI also reads WEB_CONCURRENCY for --workers
+    WEB_CONCURRENCY: int = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    
+    # CORS Settings, e.g. BACKEND_CORS_ORIGINS='["https://app.example.com"]'
+    BACKEND_CORS_ORIGINS: list[AnyHttpUrl] = Field(default_factory=list)
 
-    class Config:
-        case_sensitive = True
-        env_file = ".env"
+    model_config = SettingsConfigDict(case_sensitive=True, env_file=".env")
 
 settings = Settings()
\ No newline at end of file
@@ -1,26 +1,69 @@
+from contextlib import asynccontextmanager
+import os
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from .auth.passwords import create_password_pool
 from .auth.router import router as auth_router
 from .stalls.router import router as stalls_router
 from .menus.router import router as menus_router
 from .reviews.router import router as reviews_router
 from .config import settings
+from .utils.dynamodb import DYNAMODB_CONFIG, get_session, open_tables
+from .utils.responses import ORJSONResponse
+from .utils.s3 import S3_CONFIG
+from .utils.cache import create_redis_client
+from .utils.location import warm_up_kernels
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Password hashing runs in worker processes to keep the event loop free,
+    # sharing the cores with the other uvicorn workers
+    app.state.password_pool = create_password_pool(
+        max_workers=max(1, (os.cpu_count() or 1) // settings.WEB_CONCURRENCY)
+    )
+    
+    # Compile the location search kernels before taking traffic
+    warm_up_kernels()
+    
+    # Optional response cache for stall searches
+    app.state.redis = create_redis_client()
+    
+    # One async DynamoDB resource and S3 client, with their connection pools,
+    # shared by every request
+    session = get_session()
+    async with session.resource("dynamodb", config=DYNAMODB_CONFIG) as dynamodb, \
+            session.client("s3", config=S3_CONFIG) as s3_client:
+        await open_tables(app, dynamodb)
+        app.state.s3_client = s3_client
+        yield
+    
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+    app.state.password_pool.shutdown()
 
 app = FastAPI(
     title="Food Stall Finder API",
     description="API for finding and managing food stalls",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# Configure CORS
+# Configure CORS from the explicit allow-list and let browsers cache preflights for a day
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, replace with specific origins
+    allow_origins=[str(origin).rstrip("/") for origin in settings.BACKEND_CORS_ORIGINS],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["authorization", "content-type"],
+    expose_headers=["X-Next-Cursor"],
+    max_age=86400,
 )
 
+# Compress larger responses such as menu and review lists
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 # Include routers
 app.include_router(auth_router, prefix="/auth", tags=["Authentication"])
 app.include_router(stalls_router, prefix="/stalls", tags=["Food Stalls"])
@@ -37,4 +80,13 @@ def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=settings.WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        proxy_headers=True,
+        log_level="info"
+    )
\ No newline at end of file
@@ -1,15 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, Response, status, UploadFile, File, Form
 from typing import List, Optional
 from pydantic import BaseModel
-from datetime import datetime
-import uuid
-import boto3
-from ..auth.jwt import get_current_user, get_current_owner
-from ..utils.dynamodb import get_dynamodb_resource
-from ..utils.s3 import upload_file_to_s3
+from decimal import Decimal
+import asyncio
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from ..auth.jwt import CurrentUser, CurrentOwner
+from ..stalls.ownership import get_stall_owner, stall_exists_check, invalidate_stall_owner
+from ..utils.dynamodb import get_stalls_table, get_menu_items_table, serialize_item, encode_cursor, decode_cursor
+from ..utils.s3 import get_s3_client, s3_object_key, s3_object_url, upload_to_s3_key, delete_s3_object
+from ..utils.responses import ORJSONResponse
+from ..utils.ids import new_id, now_iso
 
 router = APIRouter()
 
+# Condition builders are reused across requests; only the values are bound per call
+_STALL_ID_KEY = Key("stall_id")
+_CATEGORY_KEY = Key("category")
+_STALL_ID_ATTR = Attr("stall_id")
+_CATEGORY_ATTR = Attr("category")
+
+# Key attributes of a stall_id-created_at-index LastEvaluatedKey: the table
+# key plus the index key
+_CURSOR_KEY_ATTRIBUTES = frozenset(["item_id", "stall_id", "created_at"])
+
 # Models
 class MenuItemBase(BaseModel):
     name: str
@@ -27,138 +41,177 @@ class MenuItemResponse(MenuItemBase):
     created_at: str
     updated_at: str
 
-# DynamoDB resource
-dynamodb = get_dynamodb_resource()
-stalls_table = dynamodb.Table("food_stall_finder_stalls")
-menu_items_table = dynamodb.Table("food_stall_finder_menu_items")
+async def _menu_item_condition_error(menu_items_table, item_id: str) -> HTTPException:
+    # A conditional write failed; a read on this rare path tells us why
+    response = await menu_items_table.get_item(Key={"item_id": item_id})
+    
+    if not response.get("Item"):
+        return HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Menu item not found"
+        )
+    
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Menu item does not belong to this stall"
+    )
 
 @router.post("/stalls/{stall_id}/menu", response_model=MenuItemResponse, status_code=status.HTTP_201_CREATED)
 async def create_menu_item(
     stall_id: str,
+    current_user: CurrentOwner,
     name: str = Form(...),
     price: float = Form(...),
     description: str = Form(...),
     category: str = Form(...),
     image: UploadFile = File(...),
-    current_user: dict = Depends(get_current_owner)
+    stalls_table=Depends(get_stalls_table),
+    menu_items_table=Depends(get_menu_items_table),
+    s3_client=Depends(get_s3_client)
 ):
     # Check if stall exists and belongs to the current user
-    response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = response.get("Item")
+    owner_id = await get_stall_owner(stalls_table, stall_id)
     
-    if not stall:
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    if stall["owner_id"] != current_user["user_id"]:
+    if owner_id != current_user["user_id"]:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not the owner of this stall"
         )
     
     # Upload image to S3
-    image_url = await upload_file_to_s3(image, prefix=f"menu_items/{stall_id}")
+    image_key = await s3_object_key(image, prefix=f"menu_items/{stall_id}")
+    uploaded = await upload_to_s3_key(s3_client, image, image_key)
     
     # Create menu item
-    item_id = str(uuid.uuid4())
-    timestamp = datetime.utcnow().isoformat()
+    item_id = new_id()
+    timestamp = now_iso()
     
     new_menu_item = {
         "item_id": item_id,
         "stall_id": stall_id,
         "name": name,
-        "price": price,
+        "price": Decimal(str(price)),
         "description": description,
         "category": category,
-        "image_url": image_url,
+        "image_url": s3_object_url(image_key),
+        "image_key": image_key,
         "created_at": timestamp,
         "updated_at": timestamp
     }
     
-    menu_items_table.put_item(Item=new_menu_item)
+    # The owner may be cached from before the stall was deleted through
+    # another worker, so only write the item if the stall still exists
+    try:
+        await menu_items_table.meta.client.transact_write_items(
+            TransactItems=[
+                stall_exists_check(stalls_table, stall_id),
+                {"Put": {"TableName": menu_items_table.name, "Item": serialize_item(new_menu_item)}}
+            ]
+        )
+    except ClientError as e:
+        reasons = e.response.get("CancellationReasons", [])
+        if not reasons or reasons[0].get("Code") != "ConditionalCheckFailed":
+            raise
+        invalidate_stall_owner(stall_id)
+        if uploaded:
+            await delete_s3_object(s3_client, image_key)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Stall not found"
+        )
     
     return new_menu_item
 
-@router.get("/stalls/{stall_id}/menu", response_model=List[MenuItemResponse])
+@router.get("/stalls/{stall_id}/menu", response_model=List[MenuItemResponse], response_class=ORJSONResponse)
 async def get_menu_items(
     stall_id: str,
+    http_response: Response,
+    current_user: CurrentUser,
     category: Optional[str] = None,
-    current_user: dict = Depends(get_current_user)
+    cursor: Optional[str] = None,
+    stalls_table=Depends(get_stalls_table),
+    menu_items_table=Depends(get_menu_items_table)
 ):
-    # Check if stall exists
-    response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = response.get("Item")
+    # Build the menu items query
+    query_kwargs = {
+        "IndexName": "stall_id-created_at-index",
+        "KeyConditionExpression": _STALL_ID_KEY.eq(stall_id)
+    }
+    
+    if category:
+        query_kwargs["FilterExpression"] = _CATEGORY_ATTR.eq(category)
+    
+    if cursor:
+        try:
+            start = decode_cursor(cursor, _CURSOR_KEY_ATTRIBUTES)
+            if start["stall_id"] != stall_id:
+                raise ValueError("Invalid cursor")
+            query_kwargs["ExclusiveStartKey"] = start
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+    
+    # Look up the stall and its menu items concurrently
+    owner_id, response = await asyncio.gather(
+        get_stall_owner(stalls_table, stall_id),
+        menu_items_table.query(**query_kwargs)
+    )
     
-    if not stall:
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    # Get menu items
-    if category:
-        response = menu_items_table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr("stall_id").eq(stall_id) & 
-                            boto3.dynamodb.conditions.Attr("category").eq(category)
-        )
-    else:
-        response = menu_items_table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr("stall_id").eq(stall_id)
-        )
-    
     menu_items = response.get("Items", [])
     
+    # Hand out a cursor for the next page, if any
+    if "LastEvaluatedKey" in response:
+        http_response.headers["X-Next-Cursor"] = encode_cursor(response["LastEvaluatedKey"])
+    
     return menu_items
 
 @router.put("/stalls/{stall_id}/menu/{item_id}", response_model=MenuItemResponse)
 async def update_menu_item(
     stall_id: str,
     item_id: str,
+    current_user: CurrentOwner,
     name: Optional[str] = Form(None),
     price: Optional[float] = Form(None),
     description: Optional[str] = Form(None),
     category: Optional[str] = Form(None),
     image: Optional[UploadFile] = File(None),
-    current_user: dict = Depends(get_current_owner)
+    stalls_table=Depends(get_stalls_table),
+    menu_items_table=Depends(get_menu_items_table),
+    s3_client=Depends(get_s3_client)
 ):
     # Check if stall exists and belongs to the current user
-    stall_response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = stall_response.get("Item")
+    owner_id = await get_stall_owner(stalls_table, stall_id)
     
-    if not stall:
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    if stall["owner_id"] != current_user["user_id"]:
+    if owner_id != current_user["user_id"]:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not the owner of this stall"
         )
     
-    # Check if menu item exists
-    menu_response = menu_items_table.get_item(Key={"item_id": item_id})
-    menu_item = menu_response.get("Item")
-    
-    if not menu_item:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Menu item not found"
-        )
-    
-    if menu_item["stall_id"] != stall_id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Menu item does not belong to this stall"
-        )
-    
     # Update fields
     update_expression = "SET updated_at = :updated_at"
     expression_attribute_values = {
-        ":updated_at": datetime.utcnow().isoformat()
+        ":updated_at": now_iso()
     }
     
     if name:
@@ -179,100 +232,111 @@ async def update_menu_item(
     
     # Upload new image if provided
     if image:
-        image_url = await upload_file_to_s3(image, prefix=f"menu_items/{stall_id}")
-        update_expression += ", image_url = :image_url"
-        expression_attribute_values[":image_url"] = image_url
-    
-    # Update menu item in DynamoDB
-    response = menu_items_table.update_item(
-        Key={"item_id": item_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attribute_values,
-        ExpressionAttributeNames={
-            "#name": "name"
-        } if name else {},
-        ReturnValues="ALL_NEW"
-    )
+        image_key = await s3_object_key(image, prefix=f"menu_items/{stall_id}")
+        await upload_to_s3_key(s3_client, image, image_key)
+        update_expression += ", image_url = :image_url, image_key = :image_key"
+        expression_attribute_values[":image_url"] = s3_object_url(image_key)
+        expression_attribute_values[":image_key"] = image_key
+    
+    # Update menu item in DynamoDB, only if it exists and belongs to this stall
+    try:
+        response = await menu_items_table.update_item(
+            Key={"item_id": item_id},
+            UpdateExpression=update_expression,
+            ConditionExpression=_STALL_ID_ATTR.eq(stall_id),
+            ExpressionAttributeValues=expression_attribute_values,
+            ExpressionAttributeNames={
+                "#name": "name"
+            } if name else {},
+            ReturnValues="ALL_NEW"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        raise await _menu_item_condition_error(menu_items_table, item_id)
     
     updated_menu_item = response.get("Attributes")
     
     return updated_menu_item
 
-@router.delete("/stalls/{stall_id}/menu/{item_id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/stalls/{stall_id}/menu/{item_id}", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def delete_menu_item(
     stall_id: str,
     item_id: str,
-    current_user: dict = Depends(get_current_owner)
-):
+    current_user: CurrentOwner,
+    stalls_table=Depends(get_stalls_table),
+    menu_items_table=Depends(get_menu_items_table)
+) -> Response:
     # Check if stall exists and belongs to the current user
-    stall_response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = stall_response.get("Item")
+    owner_id = await get_stall_owner(stalls_table, stall_id)
     
-    if not stall:
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    if stall["owner_id"] != current_user["user_id"]:
+    if owner_id != current_user["user_id"]:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not the owner of this stall"
         )
     
-    # Check if menu item exists
-    menu_response = menu_items_table.get_item(Key={"item_id": item_id})
-    menu_item = menu_response.get("Item")
-    
-    if not menu_item:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Menu item not found"
-        )
-    
-    if menu_item["stall_id"] != stall_id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Menu item does not belong to this stall"
+    # Delete menu item, only if it exists and belongs to this stall
+    try:
+        await menu_items_table.delete_item(
+            Key={"item_id": item_id},
+            ConditionExpression=_STALL_ID_ATTR.eq(stall_id)
         )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        raise await _menu_item_condition_error(menu_items_table, item_id)
     
-    # Delete menu item
-    menu_items_table.delete_item(Key={"item_id": item_id})
-    
-    return None
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
-@router.delete("/stalls/{stall_id}/menu/category/{category}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/stalls/{stall_id}/menu/category/{category}", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def delete_menu_items_by_category(
     stall_id: str,
     category: str,
-    current_user: dict = Depends(get_current_owner)
-):
+    current_user: CurrentOwner,
+    stalls_table=Depends(get_stalls_table),
+    menu_items_table=Depends(get_menu_items_table)
+) -> Response:
     # Check if stall exists and belongs to the current user
-    stall_response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = stall_response.get("Item")
+    owner_id = await get_stall_owner(stalls_table, stall_id)
     
-    if not stall:
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    if stall["owner_id"] != current_user["user_id"]:
+    if owner_id != current_user["user_id"]:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not the owner of this stall"
         )
     
-    # Get all menu items in the category
-    response = menu_items_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr("stall_id").eq(stall_id) & 
-                        boto3.dynamodb.conditions.Attr("category").eq(category)
-    )
-    
-    menu_items = response.get("Items", [])
-    
-    # Delete all menu items in the category
-    for item in menu_items:
-        menu_items_table.delete_item(Key={"item_id": item["item_id"]})
-    
-    return None
\ No newline at end of file
+    # Get the keys of all menu items in the category
+    query_kwargs = {
+        "IndexName": "stall_id-category-index",
+        "KeyConditionExpression": _STALL_ID_KEY.eq(stall_id) & _CATEGORY_KEY.eq(category),
+        "ProjectionExpression": "item_id"
+    }
+    menu_items = []
+    
+    while True:
+        response = await menu_items_table.query(**query_kwargs)
+        menu_items.extend(response.get("Items", []))
+        
+        if "LastEvaluatedKey" not in response:
+            break
+        query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    
+    # Delete all menu items in the category, 25 per request
+    async with menu_items_table.batch_writer() as batch:
+        for item in menu_items:
+            await batch.delete_item(Key={"item_id": item["item_id"]})
+    
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
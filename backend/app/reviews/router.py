@@ -1,14 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, Depends, HTTPException, Response, status, Body
 from typing import List, Optional
 from pydantic import BaseModel
-from datetime import datetime
-import uuid
-import boto3
-from ..auth.jwt import get_current_user
-from ..utils.dynamodb import get_dynamodb_resource
+import asyncio
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from ..auth.jwt import CurrentUser
+from ..stalls.ownership import get_stall_owner, stall_exists_check, invalidate_stall_owner
+from ..config import settings
+from ..utils.dynamodb import get_dynamodb, get_stalls_table, get_reviews_table, batch_get_items, serialize_item, encode_cursor, decode_cursor
+from ..utils.responses import ORJSONResponse
+from ..utils.ids import stable_id, now_iso
 
 router = APIRouter()
 
+# Condition builders are reused across requests; only the values are bound per call
+_STALL_ID_KEY = Key("stall_id")
+_STALL_ID_ATTR = Attr("stall_id")
+_USER_ID_ATTR = Attr("user_id")
+
+# Key attributes of a stall_id-created_at-index LastEvaluatedKey: the table
+# key plus the index key
+_CURSOR_KEY_ATTRIBUTES = frozenset(["review_id", "stall_id", "created_at"])
+
 # Models
 class ReviewBase(BaseModel):
     rating: int
@@ -25,47 +38,52 @@ class ReviewResponse(ReviewBase):
     created_at: str
     updated_at: str
 
-# DynamoDB resource
-dynamodb = get_dynamodb_resource()
-stalls_table = dynamodb.Table("food_stall_finder_stalls")
-reviews_table = dynamodb.Table("food_stall_finder_reviews")
-users_table = dynamodb.Table("food_stall_finder_users")
+async def _review_condition_error(reviews_table, review_id: str, stall_id: str) -> HTTPException:
+    # A conditional write failed; a read on this rare path tells us why
+    response = await reviews_table.get_item(Key={"review_id": review_id})
+    existing_review = response.get("Item")
+    
+    if not existing_review:
+        return HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Review not found"
+        )
+    
+    if existing_review["stall_id"] != stall_id:
+        return HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Review does not belong to this stall"
+        )
+    
+    return HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="You are not the author of this review"
+    )
 
 @router.post("/stalls/{stall_id}/reviews", response_model=ReviewResponse, status_code=status.HTTP_201_CREATED)
 async def create_review(
     stall_id: str,
     review: ReviewCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: CurrentUser,
+    stalls_table=Depends(get_stalls_table),
+    reviews_table=Depends(get_reviews_table)
 ):
     # Check if stall exists
-    stall_response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = stall_response.get("Item")
+    owner_id = await get_stall_owner(stalls_table, stall_id)
     
-    if not stall:
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
     # Check if the current user is the owner of the stall (can't review own stall)
-    if stall["owner_id"] == current_user["user_id"]:
+    if owner_id == current_user["user_id"]:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You cannot review your own stall"
         )
     
-    # Check if the user already has a review for this stall
-    response = reviews_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr("stall_id").eq(stall_id) & 
-                        boto3.dynamodb.conditions.Attr("user_id").eq(current_user["user_id"])
-    )
-    
-    if response.get("Items"):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="You have already reviewed this stall. Please edit your existing review."
-        )
-    
     # Validate rating
     if review.rating < 1 or review.rating > 5:
         raise HTTPException(
@@ -73,46 +91,109 @@ async def create_review(
             detail="Rating must be between 1 and 5"
         )
     
-    # Create review
-    review_id = str(uuid.uuid4())
-    timestamp = datetime.utcnow().isoformat()
+    # Create review, with an id derived from the stall and the user so a
+    # second review by the same user fails the conditional put
+    review_id = stable_id(stall_id, current_user["user_id"])
+    timestamp = now_iso()
     
     new_review = {
         "review_id": review_id,
         "stall_id": stall_id,
         "user_id": current_user["user_id"],
-        "user_name": current_user["full_name"],
         "rating": review.rating,
         "comment": review.comment,
         "created_at": timestamp,
         "updated_at": timestamp
     }
     
-    reviews_table.put_item(Item=new_review)
+    # The owner may be cached from before the stall was deleted through
+    # another worker, so only write the review if the stall still exists
+    try:
+        await reviews_table.meta.client.transact_write_items(
+            TransactItems=[
+                stall_exists_check(stalls_table, stall_id),
+                {"Put": {
+                    "TableName": reviews_table.name,
+                    "Item": serialize_item(new_review),
+                    "ConditionExpression": "attribute_not_exists(review_id)"
+                }}
+            ]
+        )
+    except ClientError as e:
+        reasons = [reason.get("Code") for reason in e.response.get("CancellationReasons", [])]
+        if "ConditionalCheckFailed" not in reasons:
+            raise
+        if reasons[0] == "ConditionalCheckFailed":
+            invalidate_stall_owner(stall_id)
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Stall not found"
+            )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You have already reviewed this stall. Please edit your existing review."
+        )
     
-    return new_review
+    return {**new_review, "user_name": current_user["full_name"]}
 
-@router.get("/stalls/{stall_id}/reviews", response_model=List[ReviewResponse])
+@router.get("/stalls/{stall_id}/reviews", response_model=List[ReviewResponse], response_class=ORJSONResponse)
 async def get_reviews(
     stall_id: str,
-    current_user: dict = Depends(get_current_user)
+    http_response: Response,
+    current_user: CurrentUser,
+    cursor: Optional[str] = None,
+    dynamodb=Depends(get_dynamodb),
+    stalls_table=Depends(get_stalls_table),
+    reviews_table=Depends(get_reviews_table)
 ):
-    # Check if stall exists
-    stall_response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = stall_response.get("Item")
+    # Build the reviews query
+    query_kwargs = {
+        "IndexName": "stall_id-created_at-index",
+        "KeyConditionExpression": _STALL_ID_KEY.eq(stall_id)
+    }
     
-    if not stall:
+    if cursor:
+        try:
+            start = decode_cursor(cursor, _CURSOR_KEY_ATTRIBUTES)
+            if start["stall_id"] != stall_id:
+                raise ValueError("Invalid cursor")
+            query_kwargs["ExclusiveStartKey"] = start
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+    
+    # Look up the stall and its reviews concurrently
+    owner_id, response = await asyncio.gather(
+        get_stall_owner(stalls_table, stall_id),
+        reviews_table.query(**query_kwargs)
+    )
+    
+    if owner_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    # Get reviews
-    response = reviews_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr("stall_id").eq(stall_id)
+    reviews = response.get("Items", [])
+    
+    # Resolve current reviewer names in one batch rather than storing them on reviews
+    user_ids = {review["user_id"] for review in reviews}
+    users = await batch_get_items(
+        dynamodb,
+        settings.DYNAMODB_USERS_TABLE,
+        [{"user_id": user_id} for user_id in user_ids],
+        projection_expression="user_id, full_name"
     )
+    name_by_id = {user["user_id"]: user["full_name"] for user in users}
     
-    reviews = response.get("Items", [])
+    for review in reviews:
+        review["user_name"] = name_by_id.get(review["user_id"], "")
+    
+    # Hand out a cursor for the next page, if any
+    if "LastEvaluatedKey" in response:
+        http_response.headers["X-Next-Cursor"] = encode_cursor(response["LastEvaluatedKey"])
     
     return reviews
 
@@ -121,42 +202,17 @@ async def update_review(
     stall_id: str,
     review_id: str,
     review: ReviewCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: CurrentUser,
+    stalls_table=Depends(get_stalls_table),
+    reviews_table=Depends(get_reviews_table)
 ):
     # Check if stall exists
-    stall_response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = stall_response.get("Item")
-    
-    if not stall:
+    if await get_stall_owner(stalls_table, stall_id) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    # Check if review exists
-    review_response = reviews_table.get_item(Key={"review_id": review_id})
-    existing_review = review_response.get("Item")
-    
-    if not existing_review:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Review not found"
-        )
-    
-    # Check if the review belongs to the stall
-    if existing_review["stall_id"] != stall_id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Review does not belong to this stall"
-        )
-    
-    # Check if the current user is the author of the review
-    if existing_review["user_id"] != current_user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not the author of this review"
-        )
-    
     # Validate rating
     if review.rating < 1 or review.rating > 5:
         raise HTTPException(
@@ -164,63 +220,52 @@ async def update_review(
             detail="Rating must be between 1 and 5"
         )
     
-    # Update review
-    timestamp = datetime.utcnow().isoformat()
-    
-    updated_review = reviews_table.update_item(
-        Key={"review_id": review_id},
-        UpdateExpression="SET rating = :rating, comment = :comment, updated_at = :updated_at",
-        ExpressionAttributeValues={
-            ":rating": review.rating,
-            ":comment": review.comment,
-            ":updated_at": timestamp
-        },
-        ReturnValues="ALL_NEW"
-    )
+    # Update review, only if it belongs to this stall and the current user
+    timestamp = now_iso()
+    
+    try:
+        updated_review = await reviews_table.update_item(
+            Key={"review_id": review_id},
+            UpdateExpression="SET rating = :rating, comment = :comment, updated_at = :updated_at",
+            ConditionExpression=_STALL_ID_ATTR.eq(stall_id) & _USER_ID_ATTR.eq(current_user["user_id"]),
+            ExpressionAttributeValues={
+                ":rating": review.rating,
+                ":comment": review.comment,
+                ":updated_at": timestamp
+            },
+            ReturnValues="ALL_NEW"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        raise await _review_condition_error(reviews_table, review_id, stall_id)
     
-    return updated_review.get("Attributes")
+    return {**updated_review.get("Attributes"), "user_name": current_user["full_name"]}
 
-@router.delete("/stalls/{stall_id}/reviews/{review_id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/stalls/{stall_id}/reviews/{review_id}", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def delete_review(
     stall_id: str,
     review_id: str,
-    current_user: dict = Depends(get_current_user)
-):
+    current_user: CurrentUser,
+    stalls_table=Depends(get_stalls_table),
+    reviews_table=Depends(get_reviews_table)
+) -> Response:
     # Check if stall exists
-    stall_response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = stall_response.get("Item")
-    
-    if not stall:
+    if await get_stall_owner(stalls_table, stall_id) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Stall not found"
         )
     
-    # Check if review exists
-    review_response = reviews_table.get_item(Key={"review_id": review_id})
-    existing_review = review_response.get("Item")
-    
-    if not existing_review:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Review not found"
-        )
-    
-    # Check if the review belongs to the stall
-    if existing_review["stall_id"] != stall_id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Review does not belong to this stall"
+    # Delete review, only if it belongs to this stall and the current user
+    try:
+        await reviews_table.delete_item(
+            Key={"review_id": review_id},
+            ConditionExpression=_STALL_ID_ATTR.eq(stall_id) & _USER_ID_ATTR.eq(current_user["user_id"])
         )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        raise await _review_condition_error(reviews_table, review_id, stall_id)
     
-    # Check if the current user is the author of the review
-    if existing_review["user_id"] != current_user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not the author of this review"
-        )
-    
-    # Delete review
-    reviews_table.delete_item(Key={"review_id": review_id})
-    
-    return None
\ No newline at end of file
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
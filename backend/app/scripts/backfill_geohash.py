@@ -0,0 +1,74 @@
+"""
+Backfill the geo_index keys on stalls written before location search used them
+
+Stalls created before the geo_index and geo4_index GSIs existed have no
+geohash, geohash5, geohash4 or top-level latitude, so they never appear in
+nearby searches until this runs. Deploy in this order:
+
+    1. Apply the Terraform change that adds the geo_index and geo4_index GSIs
+    2. Run this script: cd backend && python -m app.scripts.backfill_geohash
+    3. Deploy the application
+
+The script is idempotent and only touches stalls missing a geohash4, so it is
+safe to run again, e.g. for stalls created by an old build during the rollout.
+"""
+import asyncio
+from boto3.dynamodb.conditions import Attr
+from ..config import settings
+from ..utils.dynamodb import DYNAMODB_CONFIG, get_session
+from ..utils.location import encode_geohash
+
+async def backfill_geohash() -> int:
+    """
+    Write geohash, geohash5, geohash4 and latitude on every stall missing them
+    
+    Returns:
+        Number of stalls updated
+    """
+    updated = 0
+    
+    async with get_session().resource("dynamodb", config=DYNAMODB_CONFIG) as dynamodb:
+        stalls_table = await dynamodb.Table(settings.DYNAMODB_STALLS_TABLE)
+        scan_kwargs = {
+            "FilterExpression": Attr("geohash4").not_exists(),
+            "ProjectionExpression": "stall_id, #location",
+            "ExpressionAttributeNames": {"#location": "location"}
+        }
+        
+        while True:
+            response = await stalls_table.scan(**scan_kwargs)
+            
+            for stall in response.get("Items", []):
+                location = stall["location"]
+                geohash = encode_geohash(
+                    float(location["latitude"]),
+                    float(location["longitude"]),
+                    precision=9
+                )
+                
+                # Skip stalls deleted since the scan read them
+                try:
+                    await stalls_table.update_item(
+                        Key={"stall_id": stall["stall_id"]},
+                        UpdateExpression=(
+                            "SET geohash = :geohash, geohash5 = :geohash5, geohash4 = :geohash4"
+                            ", latitude = :latitude"
+                        ),
+                        ConditionExpression=Attr("stall_id").exists(),
+                        ExpressionAttributeValues={
+                            ":geohash": geohash,
+                            ":geohash5": geohash[:5],
+                            ":geohash4": geohash[:4],
+                            ":latitude": location["latitude"]
+                        }
+                    )
+                except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+                    continue
+                updated += 1
+            
+            if "LastEvaluatedKey" not in response:
+                return updated
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+if __name__ == "__main__":
+    print(f"Backfilled {asyncio.run(backfill_geohash())} stalls")
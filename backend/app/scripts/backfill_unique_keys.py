@@ -0,0 +1,116 @@
+"""
+Backfill the keys that registration and review creation rely on for uniqueness
+
+Users registered before email markers existed have no EMAIL#<email> item, and
+reviews created before derived review ids have a random review_id, so neither
+is protected by the conditional writes until this runs. Deploy in this order:
+
+    1. Run this script: cd backend && python -m app.scripts.backfill_unique_keys
+    2. Deploy the application
+    3. Run this script again, for users and reviews the old build created
+       during the rollout
+
+Moving a review changes its review_id, so review ids held by clients from
+before the backfill return 404 on PUT and DELETE; clients must list the
+stall's reviews again to get the new ids.
+
+The script is idempotent, so it is safe to run again. Emails registered by
+more than one user and users with more than one review of a stall predate the
+uniqueness checks; they are counted and left for manual cleanup.
+"""
+import asyncio
+from boto3.dynamodb.conditions import Attr
+from ..config import settings
+from ..utils.dynamodb import DYNAMODB_CONFIG, get_session
+from ..utils.ids import stable_id
+
+async def backfill_email_markers(dynamodb) -> tuple:
+    """
+    Write an EMAIL#<email> marker for every user missing one
+    
+    Args:
+        dynamodb: The DynamoDB resource
+        
+    Returns:
+        Number of markers written and number of duplicate emails found
+    """
+    users_table = await dynamodb.Table(settings.DYNAMODB_USERS_TABLE)
+    scan_kwargs = {
+        "FilterExpression": Attr("email").exists(),
+        "ProjectionExpression": "user_id, email"
+    }
+    written = duplicates = 0
+    
+    while True:
+        response = await users_table.scan(**scan_kwargs)
+        
+        for user in response.get("Items", []):
+            try:
+                await users_table.put_item(
+                    Item={"user_id": f"EMAIL#{user['email']}", "email_owner_id": user["user_id"]},
+                    ConditionExpression=Attr("user_id").not_exists()
+                )
+            except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+                marker = await users_table.get_item(Key={"user_id": f"EMAIL#{user['email']}"})
+                if marker.get("Item", {}).get("email_owner_id") != user["user_id"]:
+                    duplicates += 1
+                continue
+            written += 1
+        
+        if "LastEvaluatedKey" not in response:
+            return written, duplicates
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+async def backfill_review_ids(dynamodb) -> tuple:
+    """
+    Move every review to the id derived from its stall and author
+    
+    Args:
+        dynamodb: The DynamoDB resource
+        
+    Returns:
+        Number of reviews moved and number of duplicate reviews found
+    """
+    reviews_table = await dynamodb.Table(settings.DYNAMODB_REVIEWS_TABLE)
+    scan_kwargs = {}
+    moved = duplicates = 0
+    
+    while True:
+        response = await reviews_table.scan(**scan_kwargs)
+        
+        for review in response.get("Items", []):
+            review_id = stable_id(review["stall_id"], review["user_id"])
+            if review["review_id"] == review_id:
+                continue
+            
+            # Copy first so the review is never missing; the copy fails if
+            # the author already has a review under the derived id
+            try:
+                await reviews_table.put_item(
+                    Item={**review, "review_id": review_id},
+                    ConditionExpression=Attr("review_id").not_exists()
+                )
+            except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+                duplicates += 1
+                continue
+            
+            await reviews_table.delete_item(Key={"review_id": review["review_id"]})
+            moved += 1
+        
+        if "LastEvaluatedKey" not in response:
+            return moved, duplicates
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+async def backfill_unique_keys() -> None:
+    """
+    Backfill email markers, then derived review ids
+    """
+    async with get_session().resource("dynamodb", config=DYNAMODB_CONFIG) as dynamodb:
+        written, duplicate_emails = await backfill_email_markers(dynamodb)
+        print(f"Wrote {written} email markers, found {duplicate_emails} duplicate emails")
+        
+        moved, duplicate_reviews = await backfill_review_ids(dynamodb)
+        print(f"Moved {moved} reviews, found {duplicate_reviews} duplicate reviews")
+
+if __name__ == "__main__":
+    asyncio.run(backfill_unique_keys())
@@ -0,0 +1,145 @@
+from typing import List, NamedTuple
+import asyncio
+import numpy as np
+from boto3.dynamodb.conditions import Key
+from cachetools import TTLCache
+from ..utils.location import haversine_terms
+
+class StallCoordinates(NamedTuple):
+    stalls: list
+    terms: np.ndarray
+
+# The GSI and its hash key for cells of each geohash precision
+_GEO_INDEXES = {
+    5: ("geo_index", Key("geohash5")),
+    4: ("geo4_index", Key("geohash4"))
+}
+
+# Whole geohash cells of stalls, with their coordinates already unboxed from
+# Decimal into contiguous float32 haversine terms; writes drop the cells they touch
+_cell_cache = TTLCache(maxsize=10_000, ttl=30)
+
+# The shared stalls cache generation the cells above were loaded under
+_cells_generation = None
+
+# Cache entry for the full table, used when a search can't be covered by cells
+_ALL_STALLS = "*"
+
+def _to_coordinates(stalls: list) -> StallCoordinates:
+    latitudes = np.fromiter(
+        (float(stall["location"]["latitude"]) for stall in stalls),
+        dtype=np.float32,
+        count=len(stalls)
+    )
+    longitudes = np.fromiter(
+        (float(stall["location"]["longitude"]) for stall in stalls),
+        dtype=np.float32,
+        count=len(stalls)
+    )
+    return StallCoordinates(stalls=stalls, terms=haversine_terms(latitudes, longitudes))
+
+async def _read_all_pages(read, **kwargs) -> list:
+    items = []
+    
+    while True:
+        response = await read(**kwargs)
+        items.extend(response.get("Items", []))
+        
+        if "LastEvaluatedKey" not in response:
+            return items
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+async def get_stall_cells(stalls_table, cells: List[str]) -> StallCoordinates:
+    """
+    Get the stalls in a set of geohash cells, served from an in-process
+    cache when possible
+    
+    Args:
+        stalls_table: The async stalls Table
+        cells: Geohashes of one of the precisions in _GEO_INDEXES
+        
+    Returns:
+        The stalls of every cell with their coordinates as parallel arrays
+    """
+    found = {cell: _cell_cache.get(cell) for cell in cells}
+    missing = [cell for cell, coordinates in found.items() if coordinates is None]
+    
+    # Load all the missing cells concurrently
+    loaded = await asyncio.gather(*(
+        _read_all_pages(
+            stalls_table.query,
+            IndexName=_GEO_INDEXES[len(cell)][0],
+            KeyConditionExpression=_GEO_INDEXES[len(cell)][1].eq(cell)
+        )
+        for cell in missing
+    ))
+    for cell, stalls in zip(missing, loaded):
+        found[cell] = _cell_cache[cell] = _to_coordinates(stalls)
+    
+    if not found:
+        return _to_coordinates([])
+    
+    if len(found) == 1:
+        return next(iter(found.values()))
+    
+    stalls = [stall for coordinates in found.values() for stall in coordinates.stalls]
+    terms = np.concatenate([coordinates.terms for coordinates in found.values()], axis=1)
+    
+    # A stall moved by another worker can still sit in a cell cached here
+    # as well as in its new cell; keep only its newest copy
+    newest = {}
+    for index, stall in enumerate(stalls):
+        previous = newest.get(stall["stall_id"])
+        if previous is None or stall["updated_at"] > stalls[previous]["updated_at"]:
+            newest[stall["stall_id"]] = index
+    
+    if len(newest) < len(stalls):
+        keep = np.fromiter(sorted(newest.values()), dtype=np.intp, count=len(newest))
+        stalls = [stalls[index] for index in keep]
+        terms = terms[:, keep]
+    
+    return StallCoordinates(stalls=stalls, terms=terms)
+
+async def get_all_stalls(stalls_table) -> StallCoordinates:
+    """
+    Get every stall, served from an in-process cache when possible
+    
+    Args:
+        stalls_table: The async stalls Table
+        
+    Returns:
+        All stalls with their coordinates as parallel arrays
+    """
+    coordinates = _cell_cache.get(_ALL_STALLS)
+    
+    if coordinates is None:
+        stalls = await _read_all_pages(stalls_table.scan)
+        coordinates = _cell_cache[_ALL_STALLS] = _to_coordinates(stalls)
+    
+    return coordinates
+
+def sync_stall_cells(generation: str) -> None:
+    """
+    Drop every cached cell if a stall was written through any worker since
+    the cells were loaded
+    
+    Args:
+        generation: The current shared stalls cache generation
+    """
+    global _cells_generation
+    
+    if generation != _cells_generation:
+        _cell_cache.clear()
+        _cells_generation = generation
+
+def invalidate_stall_cells(*geohashes) -> None:
+    """
+    Drop the cached cells a stall was or is now in after it changes
+    
+    Args:
+        *geohashes: The stall's old and new geohash5, None entries are ignored
+    """
+    for geohash in filter(None, geohashes):
+        for precision in _GEO_INDEXES:
+            _cell_cache.pop(geohash[:precision], None)
+    _cell_cache.pop(_ALL_STALLS, None)
@@ -0,0 +1,67 @@
+from typing import Optional
+from cachetools import TTLCache
+from ..utils.dynamodb import serialize_item
+
+# Stall owners rarely change, so menu and review mutations can skip the
+# stalls table lookup for a while; unknown stalls are remembered briefly
+_stall_owner_cache = TTLCache(maxsize=50_000, ttl=30)
+_missing_stall_cache = TTLCache(maxsize=10_000, ttl=5)
+
+async def get_stall_owner(stalls_table, stall_id: str) -> Optional[str]:
+    """
+    Get the owner of a stall, served from an in-process cache when possible
+    
+    Args:
+        stalls_table: The async stalls Table
+        stall_id: The stall to look up
+        
+    Returns:
+        The owner's user_id, or None if the stall doesn't exist
+    """
+    owner_id = _stall_owner_cache.get(stall_id)
+    if owner_id is not None:
+        return owner_id
+    
+    if stall_id in _missing_stall_cache:
+        return None
+    
+    response = await stalls_table.get_item(
+        Key={"stall_id": stall_id},
+        ProjectionExpression="owner_id"
+    )
+    stall = response.get("Item")
+    
+    if stall is None:
+        _missing_stall_cache[stall_id] = True
+        return None
+    
+    _stall_owner_cache[stall_id] = stall["owner_id"]
+    return stall["owner_id"]
+
+def stall_exists_check(stalls_table, stall_id: str) -> dict:
+    """
+    Build a TransactWriteItems entry that fails if the stall is gone, for
+    writes that other workers' cached owners would otherwise let through
+    
+    Args:
+        stalls_table: The async stalls Table
+        stall_id: The stall the write belongs to
+        
+    Returns:
+        A ConditionCheck transaction item
+    """
+    return {"ConditionCheck": {
+        "TableName": stalls_table.name,
+        "Key": serialize_item({"stall_id": stall_id}),
+        "ConditionExpression": "attribute_exists(stall_id)"
+    }}
+
+def invalidate_stall_owner(stall_id: str) -> None:
+    """
+    Drop any cached owner or miss for a stall after it is created or deleted
+    
+    Args:
+        stall_id: The stall that changed
+    """
+    _stall_owner_cache.pop(stall_id, None)
+    _missing_stall_cache.pop(stall_id, None)
@@ -1,16 +1,34 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status, UploadFile, File, Form
 from typing import List, Optional
 from pydantic import BaseModel
-from datetime import datetime
-import uuid
-import boto3
-from ..auth.jwt import get_current_user, get_current_owner
-from ..utils.dynamodb import get_dynamodb_resource
-from ..utils.s3 import upload_file_to_s3
-from ..utils.location import calculate_distance
+from decimal import Decimal
+import asyncio
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from ..auth.jwt import CurrentUser, CurrentOwner
+from ..utils.dynamodb import get_stalls_table, get_menu_items_table, get_reviews_table, encode_cursor, decode_cursor
+from ..utils.s3 import get_s3_client, s3_object_key, new_s3_object_key, s3_object_url, upload_to_s3_key, delete_s3_object, delete_s3_objects
+from ..utils.cache import STALLS_CACHE_TTL, get_redis, get_stalls_generation, stalls_cache_key, get_cached, set_cached, invalidate_stalls_cache
+from ..utils.responses import ORJSONResponse, dump_json
+from ..utils.location import find_within_radius, encode_geohash, bounding_box, geohash_cells
+from ..utils.ids import new_id, now_iso
+from .index import get_stall_cells, get_all_stalls, sync_stall_cells, invalidate_stall_cells
+from .ownership import get_stall_owner, invalidate_stall_owner
 
 router = APIRouter()
 
+_STALL_ID_KEY = Key("stall_id")
+_OWNER_ID_ATTR = Attr("owner_id")
+
+# Searches use the finest geohash precision, each with its own GSI, that
+# covers them in at most this many cells, and fall back to a scan otherwise
+_GEO_PRECISIONS = (5, 4)
+_MAX_GEO_CELLS = 64
+
+# Exact attributes of listing and location search cursors
+_LIST_CURSOR_ATTRIBUTES = frozenset(["stall_id"])
+_OFFSET_CURSOR_ATTRIBUTES = frozenset(["offset"])
+
 # Models
 class LocationModel(BaseModel):
     latitude: float
@@ -33,28 +51,158 @@ class StallResponse(StallBase):
     updated_at: str
     distance: Optional[float] = None
 
-# DynamoDB resource
-dynamodb = get_dynamodb_resource()
-stalls_table = dynamodb.Table("food_stall_finder_stalls")
-menu_items_table = dynamodb.Table("food_stall_finder_menu_items")
-reviews_table = dynamodb.Table("food_stall_finder_reviews")
+# The cursor is part of the body rather than an X-Next-Cursor header like
+# menus and reviews, so a cached search is one complete Redis value
+class StallPage(BaseModel):
+    items: List[StallResponse]
+    next_cursor: Optional[str] = None
+
+async def _delete_stall_children(table, key_name: str, stall_id: str, *attributes: str) -> list:
+    # Only read the keys of this stall's rows, plus any attributes the caller
+    # needs afterwards, then delete them 25 per request
+    query_kwargs = {
+        "IndexName": "stall_id-created_at-index",
+        "KeyConditionExpression": _STALL_ID_KEY.eq(stall_id),
+        "ProjectionExpression": ", ".join([key_name, *attributes])
+    }
+    deleted = []
+    
+    async with table.batch_writer() as batch:
+        while True:
+            response = await table.query(**query_kwargs)
+            
+            for item in response.get("Items", []):
+                await batch.delete_item(Key={key_name: item[key_name]})
+            deleted.extend(response.get("Items", []))
+            
+            if "LastEvaluatedKey" not in response:
+                break
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    
+    return deleted
 
-@router.post("/", response_model=StallResponse, status_code=status.HTTP_201_CREATED)
+async def _stall_condition_error(stalls_table, stall_id: str) -> HTTPException:
+    # A conditional write failed; a read on this rare path tells us why
+    response = await stalls_table.get_item(
+        Key={"stall_id": stall_id},
+        ProjectionExpression="stall_id"
+    )
+    
+    if not response.get("Item"):
+        return HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Stall not found"
+        )
+    
+    return HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="You are not the owner of this stall"
+    )
+
+def _covering_cells(latitude: float, longitude: float, radius: float) -> Optional[List[str]]:
+    # The geohash cells covering the circle's bounding box; None means the
+    # circle is too large or awkwardly placed to cover with cells
+    box = bounding_box(latitude, longitude, radius)
+    if box is None:
+        return None
+    
+    for precision in _GEO_PRECISIONS:
+        cells = geohash_cells(*box, precision=precision, max_cells=_MAX_GEO_CELLS)
+        if cells is not None:
+            return cells
+    return None
+
+def _stall_payload(stall: dict, distance: Optional[float] = None) -> dict:
+    # The StallResponse shape, built by hand for the read routes so they
+    # skip model validation; internal attributes like the geohash stay out
+    location = stall["location"]
+    payload = {
+        "stall_id": stall["stall_id"],
+        "owner_id": stall["owner_id"],
+        "name": stall["name"],
+        "description": stall["description"],
+        "location": {
+            "latitude": float(location["latitude"]),
+            "longitude": float(location["longitude"]),
+            "address": location["address"]
+        },
+        "image_url": stall["image_url"],
+        "created_at": stall["created_at"],
+        "updated_at": stall["updated_at"]
+    }
+    
+    if distance is not None:
+        payload["distance"] = distance
+    
+    return payload
+
+async def _search_stalls(
+    stalls_table,
+    latitude: Optional[float],
+    longitude: Optional[float],
+    radius: float,
+    limit: int,
+    start
+) -> dict:
+    # Without a location, page through the table itself
+    if latitude is None or longitude is None:
+        scan_kwargs = {"Limit": limit}
+        if start:
+            scan_kwargs["ExclusiveStartKey"] = start
+        
+        response = await stalls_table.scan(**scan_kwargs)
+        last_key = response.get("LastEvaluatedKey")
+        
+        return {
+            "items": [_stall_payload(stall) for stall in response.get("Items", [])],
+            "next_cursor": encode_cursor(last_key) if last_key else None
+        }
+    
+    # Only read stalls from the cells around the location
+    cells = _covering_cells(latitude, longitude, radius)
+    if cells is None:
+        candidates = await get_all_stalls(stalls_table)
+    else:
+        candidates = await get_stall_cells(stalls_table, cells)
+    
+    # Filter stalls within the specified radius and take a page by distance
+    offset = start or 0
+    nearby, distances, total = find_within_radius(
+        latitude, longitude, candidates.terms, radius, limit=limit, offset=offset
+    )
+    
+    return {
+        "items": [
+            _stall_payload(candidates.stalls[i], float(distance))
+            for i, distance in zip(nearby, distances)
+        ],
+        "next_cursor": encode_cursor({"offset": str(offset + limit)}) if offset + limit < total else None
+    }
+
+@router.post("/", response_model=StallResponse, response_model_exclude_unset=True, status_code=status.HTTP_201_CREATED)
 async def create_stall(
+    current_user: CurrentOwner,
     name: str = Form(...),
     description: str = Form(...),
     latitude: float = Form(...),
     longitude: float = Form(...),
     address: str = Form(...),
     image: UploadFile = File(...),
-    current_user: dict = Depends(get_current_owner)
+    stalls_table=Depends(get_stalls_table),
+    s3_client=Depends(get_s3_client),
+    redis_client=Depends(get_redis)
 ):
-    # Upload image to S3
-    image_url = await upload_file_to_s3(image, prefix=f"stalls/{current_user['user_id']}")
+    stall_id = new_id()
+    
+    # Name the image up front so the stall can be written while the image
+    # uploads; images are kept per stall so they can be deleted with it,
+    # and a new stall's prefix is empty so there is nothing to dedupe against
+    image_key = new_s3_object_key(image, prefix=f"stalls/{current_user['user_id']}/{stall_id}")
+    image_url = s3_object_url(image_key)
     
     # Create stall
-    stall_id = str(uuid.uuid4())
-    timestamp = datetime.utcnow().isoformat()
+    timestamp = now_iso()
+    geohash = encode_geohash(latitude, longitude, precision=9)
     
     new_stall = {
         "stall_id": stall_id,
@@ -62,16 +210,44 @@ async def create_stall(
         "name": name,
         "description": description,
         "location": {
-            "latitude": latitude,
-            "longitude": longitude,
+            "latitude": Decimal(str(latitude)),
+            "longitude": Decimal(str(longitude)),
             "address": address
         },
+        # The full geohash, and its prefixes and the latitude as the keys
+        # of the geo_index and geo4_index GSIs used by location searches
+        "geohash": geohash,
+        "geohash5": geohash[:5],
+        "geohash4": geohash[:4],
+        "latitude": Decimal(str(latitude)),
         "image_url": image_url,
+        "image_key": image_key,
         "created_at": timestamp,
         "updated_at": timestamp
     }
     
-    stalls_table.put_item(Item=new_stall)
+    upload_result, put_result = await asyncio.gather(
+        upload_to_s3_key(s3_client, image, image_key, check_existing=False),
+        stalls_table.put_item(Item=new_stall),
+        return_exceptions=True
+    )
+    
+    # If either half failed, undo the other as far as possible
+    error = next((result for result in (upload_result, put_result) if isinstance(result, BaseException)), None)
+    if error is not None:
+        cleanup = []
+        if not isinstance(put_result, BaseException):
+            cleanup.append(stalls_table.delete_item(Key={"stall_id": stall_id}))
+        
+        # Only remove the image if this request created it
+        if upload_result is True:
+            cleanup.append(delete_s3_object(s3_client, image_key))
+        
+        await asyncio.gather(*cleanup, return_exceptions=True)
+        raise error
+    
+    invalidate_stall_cells(new_stall["geohash5"])
+    await invalidate_stalls_cache(redis_client)
     
     return {
         **new_stall,
@@ -82,45 +258,70 @@ async def create_stall(
         }
     }
 
-@router.get("/", response_model=List[StallResponse])
+@router.get("/", response_model=None, responses={200: {"model": StallPage}})
 async def get_stalls(
-    latitude: Optional[float] = None,
-    longitude: Optional[float] = None,
-    radius: Optional[float] = 5.0,  # Radius in kilometers
-    current_user: dict = Depends(get_current_user)
+    current_user: CurrentUser,
+    latitude: Optional[float] = Query(None, ge=-90, le=90),
+    longitude: Optional[float] = Query(None, ge=-180, le=180),
+    radius: float = Query(5.0, gt=0, le=50),  # Radius in kilometers
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = None,
+    stalls_table=Depends(get_stalls_table),
+    redis_client=Depends(get_redis)
 ):
-    # Get all stalls
-    response = stalls_table.scan()
-    stalls = response.get("Items", [])
+    # Cursors hold a table key when listing, or an offset into the
+    # distance order when searching by location
+    start = None
+    if cursor:
+        try:
+            if latitude is not None and longitude is not None:
+                offset = decode_cursor(cursor, _OFFSET_CURSOR_ATTRIBUTES)["offset"]
+                if not offset.isdigit():
+                    raise ValueError("Invalid cursor")
+                start = int(offset)
+            else:
+                start = decode_cursor(cursor, _LIST_CURSOR_ATTRIBUTES)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+    
+    # Without Redis, or if it is unreachable, search without the cache
+    generation = await get_stalls_generation(redis_client)
+    if generation is None:
+        return ORJSONResponse(await _search_stalls(stalls_table, latitude, longitude, radius, limit, start))
+    
+    # Stall writes in other workers bump the generation; cells cached here
+    # before that must not be used to fill the new generation's entries
+    sync_stall_cells(generation)
     
-    # If location is provided, filter and sort by distance
+    # Nearby searches share a cache entry per ~100m of map position
     if latitude is not None and longitude is not None:
-        user_location = (latitude, longitude)
-        
-        # Calculate distance for each stall
-        for stall in stalls:
-            stall_location = (
-                stall["location"]["latitude"],
-                stall["location"]["longitude"]
-            )
-            distance = calculate_distance(user_location, stall_location)
-            stall["distance"] = distance
-        
-        # Filter stalls within the specified radius
-        stalls = [stall for stall in stalls if stall["distance"] <= radius]
-        
-        # Sort by distance
-        stalls.sort(key=lambda x: x["distance"])
+        cache_key = stalls_cache_key(
+            generation, round(latitude, 3), round(longitude, 3), radius, limit, cursor or ""
+        )
+    else:
+        cache_key = stalls_cache_key(generation, "all", limit, cursor or "")
+    
+    # Cached entries are the finished JSON body
+    cached = await get_cached(redis_client, cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
     
-    return stalls
+    content = dump_json(await _search_stalls(stalls_table, latitude, longitude, radius, limit, start))
+    await set_cached(redis_client, cache_key, content, STALLS_CACHE_TTL)
+    
+    return Response(content=content, media_type="application/json")
 
-@router.get("/{stall_id}", response_model=StallResponse)
+@router.get("/{stall_id}", response_model=None, responses={200: {"model": StallResponse}})
 async def get_stall(
     stall_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: CurrentUser,
+    stalls_table=Depends(get_stalls_table)
 ):
     # Get stall
-    response = stalls_table.get_item(Key={"stall_id": stall_id})
+    response = await stalls_table.get_item(Key={"stall_id": stall_id})
     stall = response.get("Item")
     
     if not stall:
@@ -129,122 +330,160 @@ async def get_stall(
             detail="Stall not found"
         )
     
-    return stall
+    return ORJSONResponse(_stall_payload(stall))
 
-@router.put("/{stall_id}", response_model=StallResponse)
+@router.put("/{stall_id}", response_model=StallResponse, response_model_exclude_unset=True)
 async def update_stall(
     stall_id: str,
+    current_user: CurrentOwner,
     name: Optional[str] = Form(None),
     description: Optional[str] = Form(None),
     latitude: Optional[float] = Form(None),
     longitude: Optional[float] = Form(None),
     address: Optional[str] = Form(None),
     image: Optional[UploadFile] = File(None),
-    current_user: dict = Depends(get_current_owner)
+    stalls_table=Depends(get_stalls_table),
+    s3_client=Depends(get_s3_client),
+    redis_client=Depends(get_redis)
 ):
-    # Get stall
-    response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = response.get("Item")
-    
-    if not stall:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Stall not found"
+    # Moving the stall needs its current coordinates and cell; other
+    # changes go straight to a conditional write
+    stall = None
+    if latitude is not None or longitude is not None:
+        response = await stalls_table.get_item(
+            Key={"stall_id": stall_id},
+            ProjectionExpression="#location, geohash5",
+            ExpressionAttributeNames={"#location": "location"}
         )
+        stall = response.get("Item")
+        
+        if not stall:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Stall not found"
+            )
     
-    # Check if the current user is the owner
-    if stall["owner_id"] != current_user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not the owner of this stall"
-        )
+    # Don't upload an image for someone else's stall
+    if image:
+        owner_id = await get_stall_owner(stalls_table, stall_id)
+        
+        if owner_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Stall not found"
+            )
+        
+        if owner_id != current_user["user_id"]:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You are not the owner of this stall"
+            )
     
     # Update fields
     update_expression = "SET updated_at = :updated_at"
     expression_attribute_values = {
-        ":updated_at": datetime.utcnow().isoformat()
+        ":updated_at": now_iso()
     }
+    expression_attribute_names = {}
     
     if name:
         update_expression += ", #name = :name"
         expression_attribute_values[":name"] = name
+        expression_attribute_names["#name"] = "name"
     
     if description:
         update_expression += ", description = :description"
         expression_attribute_values[":description"] = description
     
-    # Update location if any component is changed
-    if any([latitude, longitude, address]):
+    # Update only the location components that are changed
+    if address is not None:
+        update_expression += ", #location.address = :address"
+        expression_attribute_values[":address"] = address
+        expression_attribute_names["#location"] = "location"
+    
+    if stall is not None:
         current_location = stall["location"]
-        new_location = {
-            "latitude": latitude if latitude is not None else current_location["latitude"],
-            "longitude": longitude if longitude is not None else current_location["longitude"],
-            "address": address if address is not None else current_location["address"]
-        }
-        update_expression += ", #location = :location"
-        expression_attribute_values[":location"] = new_location
+        new_latitude = Decimal(str(latitude)) if latitude is not None else current_location["latitude"]
+        new_longitude = Decimal(str(longitude)) if longitude is not None else current_location["longitude"]
+        
+        # Keep the geohash and geo_index keys in step with the location
+        geohash = encode_geohash(float(new_latitude), float(new_longitude), precision=9)
+        update_expression += (
+            ", #location.latitude = :latitude, #location.longitude = :longitude"
+            ", geohash = :geohash, geohash5 = :geohash5, geohash4 = :geohash4, latitude = :latitude"
+        )
+        expression_attribute_values[":latitude"] = new_latitude
+        expression_attribute_values[":longitude"] = new_longitude
+        expression_attribute_values[":geohash"] = geohash
+        expression_attribute_values[":geohash5"] = geohash[:5]
+        expression_attribute_values[":geohash4"] = geohash[:4]
+        expression_attribute_names["#location"] = "location"
     
     # Upload new image if provided
     if image:
-        image_url = await upload_file_to_s3(image, prefix=f"stalls/{current_user['user_id']}")
-        update_expression += ", image_url = :image_url"
-        expression_attribute_values[":image_url"] = image_url
+        image_key = await s3_object_key(image, prefix=f"stalls/{current_user['user_id']}/{stall_id}")
+        await upload_to_s3_key(s3_client, image, image_key)
+        update_expression += ", image_url = :image_url, image_key = :image_key"
+        expression_attribute_values[":image_url"] = s3_object_url(image_key)
+        expression_attribute_values[":image_key"] = image_key
     
-    # Update stall in DynamoDB
-    response = stalls_table.update_item(
-        Key={"stall_id": stall_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attribute_values,
-        ExpressionAttributeNames={
-            "#name": "name",
-            "#location": "location"
-        },
-        ReturnValues="ALL_NEW"
-    )
+    # Update stall in DynamoDB if the current user is the owner
+    try:
+        response = await stalls_table.update_item(
+            Key={"stall_id": stall_id},
+            UpdateExpression=update_expression,
+            ConditionExpression=_OWNER_ID_ATTR.eq(current_user["user_id"]),
+            ExpressionAttributeValues=expression_attribute_values,
+            ExpressionAttributeNames=expression_attribute_names,
+            ReturnValues="ALL_NEW"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        raise await _stall_condition_error(stalls_table, stall_id)
     
     updated_stall = response.get("Attributes")
+    invalidate_stall_cells(stall and stall.get("geohash5"), updated_stall.get("geohash5"))
+    await invalidate_stalls_cache(redis_client)
     
     return updated_stall
 
-@router.delete("/{stall_id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/{stall_id}", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def delete_stall(
     stall_id: str,
-    current_user: dict = Depends(get_current_owner)
-):
-    # Get stall
-    response = stalls_table.get_item(Key={"stall_id": stall_id})
-    stall = response.get("Item")
-    
-    if not stall:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Stall not found"
+    current_user: CurrentOwner,
+    stalls_table=Depends(get_stalls_table),
+    menu_items_table=Depends(get_menu_items_table),
+    reviews_table=Depends(get_reviews_table),
+    s3_client=Depends(get_s3_client),
+    redis_client=Depends(get_redis)
+) -> Response:
+    # Delete stall if the current user is the owner
+    try:
+        response = await stalls_table.delete_item(
+            Key={"stall_id": stall_id},
+            ConditionExpression=_OWNER_ID_ATTR.eq(current_user["user_id"]),
+            ReturnValues="ALL_OLD"
         )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        raise await _stall_condition_error(stalls_table, stall_id)
     
-    # Check if the current user is the owner
-    if stall["owner_id"] != current_user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not the owner of this stall"
-        )
-    
-    # Delete stall
-    stalls_table.delete_item(Key={"stall_id": stall_id})
-    
-    # Delete all menu items associated with this stall
-    menu_response = menu_items_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr("stall_id").eq(stall_id)
-    )
-    
-    for item in menu_response.get("Items", []):
-        menu_items_table.delete_item(Key={"item_id": item["item_id"]})
+    stall = response.get("Attributes")
+    invalidate_stall_owner(stall_id)
+    invalidate_stall_cells(stall.get("geohash5"))
+    await invalidate_stalls_cache(redis_client)
     
-    # Delete all reviews associated with this stall
-    reviews_response = reviews_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr("stall_id").eq(stall_id)
+    # Delete all menu items and reviews associated with this stall
+    menu_items, _ = await asyncio.gather(
+        _delete_stall_children(menu_items_table, "item_id", stall_id, "image_key"),
+        _delete_stall_children(reviews_table, "review_id", stall_id)
     )
     
-    for review in reviews_response.get("Items", []):
-        reviews_table.delete_item(Key={"review_id": review["review_id"]})
+    # Delete the stall's and its menu items' images together; older records
+    # without an image_key may share their image, so those are left alone
+    image_keys = [item["image_key"] for item in [stall, *menu_items] if "image_key" in item]
+    await delete_s3_objects(s3_client, image_keys)
     
-    return None
\ No newline at end of file
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
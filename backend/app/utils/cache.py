@@ -0,0 +1,110 @@
+import logging
+from typing import Optional
+from fastapi import Request
+import redis.asyncio as redis
+from ..config import settings
+
+# The cache is best-effort: Redis errors are logged and the request carries on
+logger = logging.getLogger(__name__)
+
+# Stall searches are cached briefly; writes also bump the generation below
+STALLS_CACHE_TTL = 45
+
+_STALLS_GENERATION_KEY = "stalls:generation"
+
+def create_redis_client() -> Optional[redis.Redis]:
+    """
+    Create the Redis client the app caches responses in
+    
+    Returns:
+        A Redis client, or None if REDIS_URL is not configured
+    """
+    if not settings.REDIS_URL:
+        return None
+    # Short timeouts so an unreachable Redis falls back to DynamoDB instead
+    # of holding requests up
+    return redis.from_url(settings.REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+def get_redis(request: Request) -> Optional[redis.Redis]:
+    return request.app.state.redis
+
+async def get_stalls_generation(redis_client: Optional[redis.Redis]) -> Optional[str]:
+    """
+    Get the current stalls cache generation, bumped by every stall write
+    
+    Args:
+        redis_client: The Redis client, or None if caching is disabled
+        
+    Returns:
+        The generation, or None if the cache should not be used
+    """
+    if redis_client is None:
+        return None
+    
+    try:
+        generation = await redis_client.get(_STALLS_GENERATION_KEY)
+    except redis.RedisError as e:
+        logger.warning("Reading the stalls cache generation failed: %s", e)
+        return None
+    return (generation or b"0").decode()
+
+def stalls_cache_key(generation: str, *parts) -> str:
+    """
+    Build a cache key for a stall search under a generation
+    
+    Args:
+        generation: The generation from get_stalls_generation
+        *parts: Values identifying the search
+        
+    Returns:
+        The cache key
+    """
+    return ":".join(["stalls", generation, *map(str, parts)])
+
+async def get_cached(redis_client: redis.Redis, key: str) -> Optional[bytes]:
+    """
+    Get a cached response body
+    
+    Args:
+        redis_client: The Redis client
+        key: The cache key
+        
+    Returns:
+        The cached body, or None on a miss or a Redis error
+    """
+    try:
+        return await redis_client.get(key)
+    except redis.RedisError as e:
+        logger.warning("Reading %s from the cache failed: %s", key, e)
+        return None
+
+async def set_cached(redis_client: redis.Redis, key: str, content: bytes, ttl: int) -> None:
+    """
+    Cache a response body, ignoring Redis errors
+    
+    Args:
+        redis_client: The Redis client
+        key: The cache key
+        content: The response body
+        ttl: Seconds to keep the entry for
+    """
+    try:
+        await redis_client.setex(key, ttl, content)
+    except redis.RedisError as e:
+        logger.warning("Writing %s to the cache failed: %s", key, e)
+
+async def invalidate_stalls_cache(redis_client: Optional[redis.Redis]) -> None:
+    """
+    Orphan every cached stall search by moving to a new generation
+    
+    Args:
+        redis_client: The Redis client, or None if caching is disabled
+    """
+    if redis_client is None:
+        return
+    
+    # The write already succeeded; stale entries expire with their TTL
+    try:
+        await redis_client.incr(_STALLS_GENERATION_KEY)
+    except redis.RedisError as e:
+        logger.warning("Invalidating the stalls cache failed: %s", e)
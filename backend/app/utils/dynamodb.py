@@ -1,16 +1,187 @@
-import boto3
+from typing import Optional
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import aioboto3
+from aiobotocore.config import AioConfig
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from fastapi import Request
 from ..config import settings
 
-def get_dynamodb_resource():
+logger = logging.getLogger(__name__)
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+# Shared by every request, so keep enough pooled keep-alive connections
+# for concurrent handlers and back off adaptively when throttled
+DYNAMODB_CONFIG = AioConfig(
+    max_pool_connections=64,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True
+)
+
+_session: Optional[aioboto3.Session] = None
+_session_pid: Optional[int] = None
+
+def get_session() -> aioboto3.Session:
+    """
+    Get this worker process's aioboto3 session, which the app opens its
+    async DynamoDB and S3 clients from
+    
+    The session is created on first use rather than at import, so a worker
+    forked from a process that already imported the app gets its own
+    credentials and endpoint caches instead of sharing its parent's.
+    
+    Returns:
+        An aioboto3 session
+    """
+    global _session, _session_pid
+    
+    if _session is None or _session_pid != os.getpid():
+        _session = aioboto3.Session(
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region_name=settings.AWS_REGION
+        )
+        _session_pid = os.getpid()
+    
+    return _session
+
+async def open_tables(app, dynamodb) -> None:
+    """
+    Build the Table objects once and attach them to the app state
+    
+    Args:
+        app: The FastAPI application
+        dynamodb: The async DynamoDB resource opened by the app lifespan
+    """
+    app.state.dynamodb = dynamodb
+    app.state.users_table = await dynamodb.Table(settings.DYNAMODB_USERS_TABLE)
+    app.state.stalls_table = await dynamodb.Table(settings.DYNAMODB_STALLS_TABLE)
+    app.state.menu_items_table = await dynamodb.Table(settings.DYNAMODB_MENU_ITEMS_TABLE)
+    app.state.reviews_table = await dynamodb.Table(settings.DYNAMODB_REVIEWS_TABLE)
+
+def get_dynamodb(request: Request):
+    return request.app.state.dynamodb
+
+def get_users_table(request: Request):
+    return request.app.state.users_table
+
+def get_stalls_table(request: Request):
+    return request.app.state.stalls_table
+
+def get_menu_items_table(request: Request):
+    return request.app.state.menu_items_table
+
+def get_reviews_table(request: Request):
+    return request.app.state.reviews_table
+
+# Unprocessed keys are retried with capped exponential backoff and full
+# jitter, as AWS recommends for batch operations
+_BATCH_MAX_RETRIES = 5
+_BATCH_BASE_DELAY = 0.05
+_BATCH_MAX_DELAY = 1.0
+
+async def batch_get_items(dynamodb, table_name: str, keys: list, projection_expression: Optional[str] = None) -> list:
+    """
+    Fetch many items by key in as few BatchGetItem requests as possible
+    
+    Args:
+        dynamodb: The async DynamoDB resource
+        table_name: The table to read from
+        keys: The primary keys of the items to fetch
+        projection_expression: Optional attributes to return
+        
+    Returns:
+        The items that were found, in no particular order; keys still
+        unprocessed after the retries are logged and left out
+    """
+    items = []
+    
+    # BatchGetItem takes at most 100 keys per request
+    for start in range(0, len(keys), 100):
+        request = {"Keys": keys[start:start + 100]}
+        if projection_expression:
+            request["ProjectionExpression"] = projection_expression
+        request_items = {table_name: request}
+        
+        # Retry whatever DynamoDB leaves unprocessed under throttling
+        for attempt in range(_BATCH_MAX_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, min(_BATCH_MAX_DELAY, _BATCH_BASE_DELAY * 2 ** attempt)))
+            
+            response = await dynamodb.batch_get_item(RequestItems=request_items)
+            items.extend(response["Responses"].get(table_name, []))
+            request_items = response.get("UnprocessedKeys")
+            if not request_items:
+                break
+        else:
+            logger.warning(
+                "Gave up on %d unprocessed keys from %s",
+                len(request_items[table_name]["Keys"]), table_name
+            )
+    
+    return items
+
+def serialize_item(item: dict) -> dict:
+    """
+    Convert an item to the typed attribute format the low-level client expects
+    
+    Args:
+        item: A plain item as used with the Table resource
+        
+    Returns:
+        The item with every value in DynamoDB's typed attribute format
+    """
+    return {name: _serializer.serialize(value) for name, value in item.items()}
+
+def encode_cursor(last_evaluated_key: dict) -> str:
+    """
+    Encode a DynamoDB LastEvaluatedKey as an opaque pagination cursor
+    
+    Args:
+        last_evaluated_key: The LastEvaluatedKey from a query or scan response
+        
+    Returns:
+        A URL-safe cursor string
     """
-    Get a DynamoDB resource
+    serialized = serialize_item(last_evaluated_key)
+    return base64.urlsafe_b64encode(json.dumps(serialized).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str, key_attributes: Optional[frozenset] = None) -> dict:
+    """
+    Decode a pagination cursor back into an ExclusiveStartKey
     
+    Args:
+        cursor: A cursor produced by encode_cursor
+        key_attributes: The string key attributes the key must have exactly,
+            so a forged cursor can't make DynamoDB reject the query
+        
     Returns:
-        A boto3 DynamoDB resource
-    """
-    return boto3.resource(
-        'dynamodb',
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        region_name=settings.AWS_REGION
-    )
\ No newline at end of file
+        The key to pass as ExclusiveStartKey
+        
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        serialized = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        
+        # Check the shape before deserializing, which parses numbers with
+        # DynamoDB's strict decimal context
+        if key_attributes is not None and not (
+            isinstance(serialized, dict)
+            and serialized.keys() == key_attributes
+            and all(
+                isinstance(value, dict) and value.keys() == {"S"} and isinstance(value["S"], str)
+                for value in serialized.values()
+            )
+        ):
+            raise ValueError("Invalid cursor")
+        
+        return {name: _deserializer.deserialize(value) for name, value in serialized.items()}
+    except (ValueError, TypeError, AttributeError, ArithmeticError, RecursionError) as e:
+        raise ValueError("Invalid cursor") from e
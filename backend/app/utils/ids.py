@@ -0,0 +1,32 @@
+from datetime import datetime
+import uuid
+
+def new_id() -> str:
+    """
+    Generate a new random identifier
+    
+    Returns:
+        A UUID4 as 32 hex characters
+    """
+    return uuid.uuid4().hex
+
+def stable_id(*parts: str) -> str:
+    """
+    Derive a deterministic identifier from its parts
+    
+    Args:
+        *parts: The values that together identify the record
+        
+    Returns:
+        A UUID5 as 32 hex characters, the same for the same parts
+    """
+    return uuid.uuid5(uuid.NAMESPACE_URL, "/".join(parts)).hex
+
+def now_iso(_now=datetime.utcnow) -> str:
+    """
+    Get the current UTC time for created_at/updated_at fields
+    
+    Returns:
+        The current UTC time in ISO 8601 format
+    """
+    return _now().isoformat()
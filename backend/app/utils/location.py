@@ -1,28 +1,186 @@
-from math import radians, cos, sin, asin, sqrt
+from math import radians, degrees, cos, sin, pi
+from numba import njit
+import numpy as np
 
-def calculate_distance(point1, point2):
+def haversine_terms(latitudes, longitudes):
     """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
+    Precompute the per-point trig terms of the haversine formula
     
     Args:
-        point1: Tuple of (latitude, longitude)
-        point2: Tuple of (latitude, longitude)
+        latitudes: Array of latitudes
+        longitudes: Array of longitudes, of the same dtype
         
     Returns:
-        Distance in kilometers
+        Array of shape (5, n) holding sin(lat/2), cos(lat/2), cos(lat),
+        sin(lon/2) and cos(lon/2) in radians, of the same dtype as the inputs
     """
-    # Convert decimal degrees to radians
-    lat1, lon1 = point1
-    lat2, lon2 = point2
+    half_lat = np.radians(latitudes) / 2
+    half_lon = np.radians(longitudes) / 2
     
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    return np.stack([
+        np.sin(half_lat),
+        np.cos(half_lat),
+        np.cos(2 * half_lat),
+        np.sin(half_lon),
+        np.cos(half_lon)
+    ]).astype(np.asarray(latitudes).dtype, copy=False)
+
+# Serial on purpose: cells hold tens of stalls, less work than starting a
+# parallel region, and each uvicorn worker would get its own thread pool
+@njit(cache=True, fastmath=True)
+def _haversine_a_bulk(latitude, longitude, terms):
+    sin_half_lat1, cos_half_lat1 = sin(radians(latitude) / 2), cos(radians(latitude) / 2)
+    sin_half_lon1, cos_half_lon1 = sin(radians(longitude) / 2), cos(radians(longitude) / 2)
+    cos_lat1 = cos(radians(latitude))
+    a = np.empty(terms.shape[1], dtype=terms.dtype)
+    
+    for i in range(terms.shape[1]):
+        # sin((a - b) / 2) expanded, so no trig is evaluated per point
+        sin_half_dlat = terms[0, i] * cos_half_lat1 - terms[1, i] * sin_half_lat1
+        sin_half_dlon = terms[3, i] * cos_half_lon1 - terms[4, i] * sin_half_lon1
+        a[i] = min(sin_half_dlat**2 + cos_lat1 * terms[2, i] * sin_half_dlon**2, 1.0)
+    
+    return a
+
+def find_within_radius(latitude, longitude, terms, radius, limit=None, offset=0):
+    """
+    Find the points within a radius of an origin, nearest first, from
+    trig terms precomputed with haversine_terms
     
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
+    Args:
+        latitude: Latitude of the origin
+        longitude: Longitude of the origin
+        terms: Array from haversine_terms
+        radius: Radius in kilometers
+        limit: Maximum number of points to return, all of them if None
+        offset: Number of nearest matching points to skip
+        
+    Returns:
+        Tuple of (indices, distances, total) of the requested page of
+        matching points, distances in kilometers, and the number of matches
+    """
     r = 6371  # Radius of earth in kilometers
+    a = _haversine_a_bulk(float(latitude), float(longitude), np.ascontiguousarray(terms))
+    
+    # Distance only grows with the haversine term, so the radius test and
+    # the ordering use it directly and only matches pay for sqrt and asin
+    max_a = sin(min(radius / (2 * r), pi / 2)) ** 2
+    nearby = np.flatnonzero(a <= max_a)
+    total = len(nearby)
+    
+    # Only the points up to the end of the page need to be ordered
+    end = total if limit is None else min(offset + limit, total)
+    if end < total:
+        nearby = nearby[np.argpartition(a[nearby], end - 1)[:end]] if end else nearby[:0]
+    
+    nearby = nearby[np.argsort(a[nearby], kind="stable")][offset:end]
+    
+    return nearby, 2 * r * np.arcsin(np.sqrt(a[nearby])), total
+
+def warm_up_kernels():
+    """
+    Compile the distance kernel, or load it from numba's on-disk cache,
+    so the first requests after startup don't pay for it
+    """
+    find_within_radius(0.0, 0.0, np.zeros((5, 1), dtype=np.float32), 1.0)
+
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def _geohash_bits(precision):
+    # Geohash interleaves longitude and latitude bits, longitude first
+    bits = 5 * precision
+    return (bits + 1) // 2, bits // 2
+
+def _geohash_cell(latitude, longitude, precision):
+    lon_bits, lat_bits = _geohash_bits(precision)
+    lat_index = min(int((latitude + 90) / 180 * (1 << lat_bits)), (1 << lat_bits) - 1)
+    lon_index = min(int((longitude + 180) / 360 * (1 << lon_bits)), (1 << lon_bits) - 1)
+    return lat_index, lon_index
+
+def _geohash_from_cell(lat_index, lon_index, precision):
+    lon_bits, lat_bits = _geohash_bits(precision)
+    value = 0
+    
+    for bit in range(5 * precision):
+        if bit % 2 == 0:
+            lon_bits -= 1
+            value = (value << 1) | ((lon_index >> lon_bits) & 1)
+        else:
+            lat_bits -= 1
+            value = (value << 1) | ((lat_index >> lat_bits) & 1)
+    
+    return "".join(
+        _GEOHASH_BASE32[(value >> shift) & 31]
+        for shift in range(5 * (precision - 1), -1, -5)
+    )
+
+def encode_geohash(latitude, longitude, precision=5):
+    """
+    Encode a point as a geohash
+    
+    Args:
+        latitude: Latitude in decimal degrees
+        longitude: Longitude in decimal degrees
+        precision: Number of geohash characters
+        
+    Returns:
+        The geohash of the cell containing the point
+    """
+    lat_index, lon_index = _geohash_cell(latitude, longitude, precision)
+    return _geohash_from_cell(lat_index, lon_index, precision)
+
+def bounding_box(latitude, longitude, radius):
+    """
+    Calculate the latitude/longitude box that contains a search circle
+    
+    Args:
+        latitude: Latitude of the center in decimal degrees
+        longitude: Longitude of the center in decimal degrees
+        radius: Radius in kilometers
+        
+    Returns:
+        Tuple of (min_latitude, max_latitude, min_longitude, max_longitude),
+        or None if the box would cross a pole or the antimeridian
+    """
+    delta_lat = degrees(radius / 6371)
+    min_lat, max_lat = latitude - delta_lat, latitude + delta_lat
+    
+    if min_lat <= -90 or max_lat >= 90:
+        return None
+    
+    delta_lon = delta_lat / cos(radians(latitude))
+    min_lon, max_lon = longitude - delta_lon, longitude + delta_lon
+    
+    if min_lon < -180 or max_lon > 180:
+        return None
+    
+    return min_lat, max_lat, min_lon, max_lon
+
+def geohash_cells(min_lat, max_lat, min_lon, max_lon, precision=5, max_cells=None):
+    """
+    List the geohash cells that cover a latitude/longitude box
+    
+    Args:
+        min_lat: Southern edge in decimal degrees
+        max_lat: Northern edge in decimal degrees
+        min_lon: Western edge in decimal degrees
+        max_lon: Eastern edge in decimal degrees
+        precision: Number of geohash characters
+        max_cells: Give up instead of listing more cells than this
+        
+    Returns:
+        List of geohashes, or None if more than max_cells are needed
+    """
+    min_lat_index, min_lon_index = _geohash_cell(min_lat, min_lon, precision)
+    max_lat_index, max_lon_index = _geohash_cell(max_lat, max_lon, precision)
+    
+    # Count from the index bounds so oversized boxes cost nothing to reject
+    count = (max_lat_index - min_lat_index + 1) * (max_lon_index - min_lon_index + 1)
+    if max_cells is not None and count > max_cells:
+        return None
     
-    return c * r
\ No newline at end of file
+    return [
+        _geohash_from_cell(lat_index, lon_index, precision)
+        for lat_index in range(min_lat_index, max_lat_index + 1)
+        for lon_index in range(min_lon_index, max_lon_index + 1)
+    ]
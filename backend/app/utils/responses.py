@@ -0,0 +1,35 @@
+from decimal import Decimal
+from typing import Any
+from fastapi.responses import JSONResponse
+import orjson
+
+def _default(obj: Any):
+    # DynamoDB hands numbers back as Decimal
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError
+
+def dump_json(content: Any) -> bytes:
+    """
+    Serialize content the same way ORJSONResponse renders it
+    
+    Args:
+        content: The data to serialize
+        
+    Returns:
+        The JSON bytes
+    """
+    return orjson.dumps(
+        content,
+        default=_default,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+    )
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson instead of the stdlib json module
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
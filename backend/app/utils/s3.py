@@ -1,41 +1,141 @@
-import boto3
-import uuid
-from fastapi import UploadFile
+import asyncio
+import hashlib
+import logging
+from aiobotocore.config import AioConfig
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from fastapi import Request, UploadFile
 from ..config import settings
+from .ids import new_id
 
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-    region_name=settings.AWS_REGION
+logger = logging.getLogger(__name__)
+
+# Each multipart upload holds several connections at once, so pool enough
+# of them for concurrent uploads and keep them alive between requests
+S3_CONFIG = AioConfig(
+    max_pool_connections=64,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True
+)
+
+# Typical photos go up in a single streamed PUT; only large images are split
+# into multipart chunks, a few at a time so one upload can't drain the pool
+_transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4
 )
 
-async def upload_file_to_s3(file: UploadFile, prefix: str = "uploads") -> str:
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+def _hash_file(fileobj) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(_HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    
+    return digest.hexdigest()
+
+def get_s3_client(request: Request):
+    return request.app.state.s3_client
+
+async def _object_exists(s3_client, key: str) -> bool:
+    try:
+        await s3_client.head_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+async def s3_object_key(file: UploadFile, prefix: str = "uploads") -> str:
     """
-    Upload a file to AWS S3 bucket
+    Name an upload after its content, before it is sent
     
     Args:
         file: The file to upload
         prefix: The prefix to use for the object key
         
     Returns:
-        The URL of the uploaded file
+        The object key
     """
-    # Generate a unique filename
     file_extension = file.filename.split(".")[-1]
-    unique_filename = f"{prefix}/{str(uuid.uuid4())}.{file_extension}"
+    file_hash = await asyncio.to_thread(_hash_file, file.file)
+    return f"{prefix}/{file_hash}.{file_extension}"
+
+def new_s3_object_key(file: UploadFile, prefix: str = "uploads") -> str:
+    """
+    Name an upload that can't match an existing object, without reading it
     
-    # Read file content
-    contents = await file.read()
+    Args:
+        file: The file to upload
+        prefix: The prefix to use for the object key
+        
+    Returns:
+        The object key
+    """
+    file_extension = file.filename.split(".")[-1]
+    return f"{prefix}/{new_id()}.{file_extension}"
+
+def s3_object_url(key: str) -> str:
+    return f"https://{settings.S3_BUCKET_NAME}.s3.{settings.AWS_REGION}.amazonaws.com/{key}"
+
+async def upload_to_s3_key(s3_client, file: UploadFile, key: str, check_existing: bool = True) -> bool:
+    """
+    Stream a file to S3 under a key from s3_object_key or new_s3_object_key
+    
+    Args:
+        s3_client: The async S3 client opened by the app lifespan
+        file: The file to upload
+        key: The object key
+        check_existing: Whether to skip the upload if the key exists, only
+            useful for content-derived keys
+        
+    Returns:
+        True if the object was created, False if identical content was
+        already stored under the key
+    """
+    # A content-derived key that exists already holds identical content
+    if check_existing and await _object_exists(s3_client, key):
+        return False
     
-    # Upload to S3
-    s3_client.put_object(
-        Bucket=settings.S3_BUCKET_NAME,
-        Key=unique_filename,
-        Body=contents,
-        ContentType=file.content_type
+    await s3_client.upload_fileobj(
+        file.file,
+        settings.S3_BUCKET_NAME,
+        key,
+        ExtraArgs={"ContentType": file.content_type} if file.content_type else None,
+        Config=_transfer_config
     )
+    return True
+
+async def delete_s3_object(s3_client, key: str) -> None:
+    await s3_client.delete_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
+
+async def delete_s3_objects(s3_client, keys: list) -> None:
+    """
+    Delete many objects with as few requests as possible
+    
+    Args:
+        s3_client: The async S3 client opened by the app lifespan
+        keys: The object keys to delete, possibly repeated
+    """
+    # Records can share an image, so send each key once
+    keys = list(dict.fromkeys(keys))
     
-    # Return the URL
-    url = f"https://{settings.S3_BUCKET_NAME}.s3.{settings.AWS_REGION}.amazonaws.com/{unique_filename}"
-    return url
\ No newline at end of file
+    # DeleteObjects takes at most 1000 keys per request; in quiet mode the
+    # response lists only the keys that failed
+    for start in range(0, len(keys), 1000):
+        response = await s3_client.delete_objects(
+            Bucket=settings.S3_BUCKET_NAME,
+            Delete={
+                "Objects": [{"Key": key} for key in keys[start:start + 1000]],
+                "Quiet": True
+            }
+        )
+        for error in response.get("Errors", []):
+            logger.warning(
+                "Deleting %s from S3 failed: %s %s",
+                error.get("Key"), error.get("Code"), error.get("Message")
+            )
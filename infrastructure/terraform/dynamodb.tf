@@ -8,6 +8,17 @@ resource "aws_dynamodb_table" "users_table" {
     type = "S"
   }
   
+  attribute {
+    name = "email"
+    type = "S"
+  }
+  
+  global_secondary_index {
+    name            = "email-index"
+    hash_key        = "email"
+    projection_type = "ALL"
+  }
+  
   tags = {
     Name        = "FoodStallFinderUsers"
     Environment = var.environment
@@ -24,6 +35,36 @@ resource "aws_dynamodb_table" "stalls_table" {
     type = "S"
   }
   
+  attribute {
+    name = "geohash5"
+    type = "S"
+  }
+  
+  attribute {
+    name = "geohash4"
+    type = "S"
+  }
+  
+  attribute {
+    name = "latitude"
+    type = "N"
+  }
+  
+  global_secondary_index {
+    name            = "geo_index"
+    hash_key        = "geohash5"
+    range_key       = "latitude"
+    projection_type = "ALL"
+  }
+  
+  # Coarser cells for searches too wide to cover with geohash5 cells
+  global_secondary_index {
+    name            = "geo4_index"
+    hash_key        = "geohash4"
+    range_key       = "latitude"
+    projection_type = "ALL"
+  }
+  
   tags = {
     Name        = "FoodStallFinderStalls"
     Environment = var.environment
@@ -40,6 +81,35 @@ resource "aws_dynamodb_table" "menu_items_table" {
     type = "S"
   }
   
+  attribute {
+    name = "stall_id"
+    type = "S"
+  }
+  
+  attribute {
+    name = "category"
+    type = "S"
+  }
+  
+  attribute {
+    name = "created_at"
+    type = "S"
+  }
+  
+  global_secondary_index {
+    name            = "stall_id-category-index"
+    hash_key        = "stall_id"
+    range_key       = "category"
+    projection_type = "KEYS_ONLY"
+  }
+  
+  global_secondary_index {
+    name            = "stall_id-created_at-index"
+    hash_key        = "stall_id"
+    range_key       = "created_at"
+    projection_type = "ALL"
+  }
+  
   tags = {
     Name        = "FoodStallFinderMenuItems"
     Environment = var.environment
@@ -56,6 +126,23 @@ resource "aws_dynamodb_table" "reviews_table" {
     type = "S"
   }
   
+  attribute {
+    name = "stall_id"
+    type = "S"
+  }
+  
+  attribute {
+    name = "created_at"
+    type = "S"
+  }
+  
+  global_secondary_index {
+    name            = "stall_id-created_at-index"
+    hash_key        = "stall_id"
+    range_key       = "created_at"
+    projection_type = "ALL"
+  }
+  
   tags = {
     Name        = "FoodStallFinderReviews"
     Environment = var.environment